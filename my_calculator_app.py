@@ -6,7 +6,7 @@
 
 import streamlit as st
 import numpy as np
-import copy
+from solver_kernels import RULE_CODES, balance_prices
 
 # --------------------------------------------------------------------------
 #  新增的“安检员”函数，负责所有输入校验
@@ -30,16 +30,16 @@ def validate_inputs(total_quantity, total_price, tax_rate, prices_str, constrain
         return errors # 如果价格为空，后续校验无意义，直接返回
 
     try:
-        # 尝试转换，这能同时检测出非数字和错误的分隔符
-        known_prices_list = [float(p.strip()) for p in prices_str.split(',')]
-        if any(p < 0 for p in known_prices_list):
-            errors.append("价格数据无效：商品价格不能为负数。")
+        # 与计算阶段共用同一个解析器，这能同时检测出非数字和错误的分隔符
+        known_prices_arr = _parse_prices(prices_str)
     except ValueError:
         errors.append("价格列表格式错误：请确保所有价格都是数字，并只使用英文逗号 (,) 分隔。")
         return errors # 价格格式错误，后续校验无意义
+    if (known_prices_arr < 0).any():
+        errors.append("价格数据无效：商品价格不能为负数。")
     
     # 3. 校验逻辑关系
-    num_known_products = len(known_prices_list)
+    num_known_products = len(known_prices_arr)
     total_products = num_known_products + 1
     if total_quantity < total_products:
         errors.append(f"商品总件数 ({int(total_quantity)}) 不能少于商品种类总数 ({total_products})。")
@@ -53,21 +53,163 @@ def validate_inputs(total_quantity, total_price, tax_rate, prices_str, constrain
 
     return errors
 
+@st.cache_data(show_spinner=False)
+def _parse_prices(prices_str: str) -> np.ndarray:
+    """解析已知商品单价列表（按原始字符串缓存），校验和计算共用这一个解析器；格式错误时抛出 ValueError"""
+    # 逐项用 float() 解析：空白项、非数字会直接抛出 ValueError，全角数字（中文输入法）、1_000 这类写法也能正确识别
+    return np.array([float(p.strip()) for p in prices_str.split(',')], dtype=np.float64)
+
+@st.cache_data(show_spinner=False)
+def _validate(total_quantity, total_price, tax_rate, prices_str, constraints_key: tuple) -> list:
+    """带缓存的输入校验；constraints_key 为 (序号, 类型, 数量) 元组组成的元组"""
+    constraints = [{'idx': idx, 'type': c_type, 'value': value} for idx, c_type, value in constraints_key]
+    return validate_inputs(total_quantity, total_price, tax_rate, prices_str, constraints)
+
 # --------------------------------------------------------------------------
 #  核心计算函数 - 已升级以支持特殊限制和内部逻辑校验
 # --------------------------------------------------------------------------
-def solve_product_distribution(
+def _shift_to_price_range(quantities, known_prices, sorted_idx_asc, target_pre_tax, x_lo, x_hi):
+    """无限制条件下的解析解：按迭代算法相同的顺序（最便宜 -> 最贵，或反之）一次性挪动所需件数。
+    返回 (新的数量数组, 目标区间是否可达)；不可达时返回把能挪的件数全部挪完后的极端分配，即最接近的结果"""
+    q_last = quantities[-1]
+    known_cost = (quantities[:-1] * known_prices).sum()
+    required_known_cost_lo = target_pre_tax - x_hi * q_last
+    required_known_cost_hi = target_pre_tax - x_lo * q_last
+    if known_cost < required_known_cost_lo:
+        # 未知单价偏高：把便宜商品的件数挪给最贵的商品
+        need = required_known_cost_lo - known_cost
+        receiver, donors = sorted_idx_asc[-1], sorted_idx_asc[:-1]
+    elif known_cost > required_known_cost_hi:
+        # 未知单价偏低：把贵的商品的件数挪给最便宜的商品
+        need = known_cost - required_known_cost_hi
+        receiver, donors = sorted_idx_asc[0], sorted_idx_asc[:0:-1]
+    else:
+        return quantities, True
+
+    gain = np.abs(known_prices[receiver] - known_prices[donors]) # 每挪一件带来的总价变化
+    capacity = quantities[donors]
+    cum_gain = np.cumsum(capacity * gain)
+    j = np.searchsorted(cum_gain, need)
+    if j == len(donors):
+        movable = gain > 0
+        exhausted = quantities.copy()
+        exhausted[receiver] += capacity[movable].sum()
+        exhausted[donors[movable]] = 0
+        return exhausted, False
+    k = int(np.ceil((need - (cum_gain[j] - capacity[j] * gain[j])) / gain[j]))
+
+    shifted = quantities.copy()
+    shifted[receiver] += capacity[:j].sum() + k
+    shifted[donors[:j]] = 0
+    shifted[donors[j]] -= k
+    return shifted, True
+
+# 计算核心的状态码
+SOLVE_SUCCESS, SOLVE_WARNING, SOLVE_ZERO_UNKNOWN, SOLVE_INFEASIBLE = 0, 1, 2, 3
+
+def _solve_core(
+    total_quantity: int,
+    target_pre_tax_price: float,
+    known_prices_arr: np.ndarray,
+    x_lo: float,
+    x_hi: float,
+    rule_kind: np.ndarray,
+    rule_val: np.ndarray,
+    max_iterations: int = 200
+) -> tuple[int, float, np.ndarray]:
+    """纯数值的计算核心，不做输入校验也不构造结果字典，便于批量调用；返回 (状态码, 未知单价, 各商品件数)。
+    限制条件的上下限凑不出总件数时返回 SOLVE_INFEASIBLE。
+    max_iterations 只限制逐件交换的迭代：无限制条件时的解析解一次挪完，不受此上限约束；
+    但解析解可达却越过了过窄的单价区间时，仍会退回迭代，此时同样受此上限约束"""
+    # 求解所用的全部状态都是按商品对齐的一维数组：价格及其升序下标、限制条件、各商品件数
+    total_products = rule_kind.shape[0]
+    has_rules = bool((rule_kind >= 0).any())
+    # 稳定排序：同价商品保持原有顺序
+    sorted_idx_asc = np.argsort(known_prices_arr, kind='stable').astype(np.int64)
+
+    # --- 阶段一：初始分配 ---
+    # (此处省略了复杂的初始分配逻辑，以保持核心清晰，实际的分配逻辑已包含在之前的版本中并经过简化和测试)
+    # ... 简化的分配逻辑开始 ...
+    base_quantity = total_quantity // total_products
+    remainder = total_quantity % total_products
+    quantities = np.full(total_products, base_quantity, dtype=np.int64)
+    quantities[:remainder] += 1
+    if has_rules:
+        # 把限制条件展开为上下限数组：'==' 的上下限相同，未限制的商品上下限为 [0, 总件数]
+        fixed_mask = rule_kind == RULE_CODES['==']
+        min_arr = np.where((rule_kind == RULE_CODES['>=']) | fixed_mask, rule_val, 0)
+        max_arr = np.where((rule_kind == RULE_CODES['<=']) | fixed_mask, rule_val, total_quantity)
+        # 上下限凑不出总件数时直接返回，否则下面的差额分配永远分不完
+        if (min_arr > max_arr).any() or min_arr.sum() > total_quantity or max_arr.sum() < total_quantity:
+            return SOLVE_INFEASIBLE, float('nan'), quantities
+        temp_quantities = np.clip(quantities, min_arr, max_arr)
+        # 差额平均分给未固定的商品（未知单价商品不可能被限制，因此至少有一个）
+        unlocked = np.flatnonzero(~fixed_mask)
+        delta = total_quantity - temp_quantities.sum()
+        if unlocked.size:
+            temp_quantities[unlocked] += delta // len(unlocked)
+            temp_quantities[unlocked[:delta % len(unlocked)]] += 1
+            temp_quantities = np.clip(temp_quantities, min_arr, max_arr)
+        # 触及上下限后剩余的差额，轮流平摊给仍有剩余空间的商品（按顺序填满会挤占未知单价商品）
+        delta = total_quantity - temp_quantities.sum()
+        while delta != 0:
+            room = max_arr - temp_quantities if delta > 0 else temp_quantities - min_arr
+            open_idx = np.flatnonzero(room > 0)
+            each = abs(delta) // len(open_idx)
+            if each == 0:
+                # 差额不足每件分一个时，只给前几件各分一个
+                open_idx = open_idx[:abs(delta)]
+                each = 1
+            temp_quantities[open_idx] += np.sign(delta) * np.minimum(room[open_idx], each)
+            delta = total_quantity - temp_quantities.sum()
+        quantities = temp_quantities
+    if quantities.sum() != total_quantity:
+        quantities[0] += total_quantity - quantities.sum()
+    # ... 简化的分配逻辑结束 ...
+
+    # --- 阶段二：价格平衡微调 ---
+    if quantities[-1] == 0:
+        return SOLVE_ZERO_UNKNOWN, float('nan'), quantities
+
+    # 无特殊限制时先尝试解析解：一次性算出需要挪动的件数，不必逐件迭代
+    if not has_rules:
+        shifted, reachable = _shift_to_price_range(quantities, known_prices_arr, sorted_idx_asc, target_pre_tax_price, x_lo, x_hi)
+        calculated_x = float((target_pre_tax_price - (shifted[:-1] * known_prices_arr).sum()) / shifted[-1])
+        if x_lo <= calculated_x <= x_hi:
+            return SOLVE_SUCCESS, calculated_x, shifted
+        if not reachable:
+            # 目标区间超出所有可能组合的范围，迭代也只会走到同一个极端分配，直接返回
+            return SOLVE_WARNING, calculated_x, shifted
+
+    quantities, calculated_x, converged = balance_prices(
+        quantities, known_prices_arr, sorted_idx_asc, target_pre_tax_price, x_lo, x_hi,
+        rule_kind, rule_val, max_iterations
+    )
+    return (SOLVE_SUCCESS if converged else SOLVE_WARNING), calculated_x, quantities
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _solve_product_distribution_cached(
     total_products: int,
     total_quantity: int,
     total_price_with_tax: float,
     tax_rate: float,
-    known_prices: list[float],
-    x_price_range: list[float],
-    constraints: list = None
+    known_prices_tuple: tuple,
+    x_range_tuple: tuple,
+    constraints_tuple: tuple,
+    max_iterations: int = 200
 ) -> dict:
-    """核心计算函数，已内置逻辑冲突检测"""
+    """带缓存的计算主体，只接受可哈希参数；返回的 counts 为元组，避免缓存结果被意外修改"""
+    x_lo, x_hi = x_range_tuple
+    constraints = [{'idx': idx, 'type': c_type, 'value': value} for idx, c_type, value in constraints_tuple]
     rules = {c['idx'] - 1: {'type': c['type'], 'value': c['value']} for c in constraints} if constraints else {}
 
+    # 按商品序号展开为平行数组（-1 表示无限制），供初始分配和编译后的内核使用
+    rule_kind = np.full(total_products, -1, dtype=np.int8)
+    rule_val = np.zeros(total_products, dtype=np.int64)
+    for i in rules:
+        rule_kind[i] = RULE_CODES[rules[i]['type']]
+        rule_val[i] = rules[i]['value']
+
     # --- 内部逻辑校验 ---
     # 校验1：限制条件是否自相矛盾
     for i in rules:
@@ -92,121 +234,103 @@ def solve_product_distribution(
     if min_sum > total_quantity:
         return {"status": "错误", "message": f"特殊限制逻辑冲突：您设定的各项‘最少/固定’数量之和 ({min_sum}件) 已超过商品总件数 ({int(total_quantity)})。"}
 
-    # --- 阶段一：初始分配 ---
-    quantities = [0] * total_products
-    # (此处省略了复杂的初始分配逻辑，以保持核心清晰，实际的分配逻辑已包含在之前的版本中并经过简化和测试)
-    # ... 简化的分配逻辑开始 ...
-    base_quantity = total_quantity // total_products
-    remainder = total_quantity % total_products
-    quantities = [base_quantity + 1] * remainder + [base_quantity] * (total_products - remainder)
-    if constraints:
-        temp_quantities = copy.deepcopy(quantities)
-        for _ in range(total_products * 2):
-            for i in rules:
-                if rules[i]['type'] == '==': temp_quantities[i] = rules[i]['value']
-                elif rules[i]['type'] == '>=' and temp_quantities[i] < rules[i]['value']: temp_quantities[i] = rules[i]['value']
-                elif rules[i]['type'] == '<=' and temp_quantities[i] > rules[i]['value']: temp_quantities[i] = rules[i]['value']
-            delta = total_quantity - sum(temp_quantities)
-            unlocked = [i for i in range(total_products) if i not in rules or rules[i]['type'] != '==']
-            if unlocked:
-                add_each = delta // len(unlocked)
-                for i in unlocked: temp_quantities[i] += add_each
-                remainder_add = delta % len(unlocked)
-                for i in range(remainder_add): temp_quantities[unlocked[i]] += 1
-        quantities = temp_quantities
-    if sum(quantities) != total_quantity:
-        quantities[0] += total_quantity - sum(quantities)
-    # ... 简化的分配逻辑结束 ...
-
-    # --- 阶段二：价格平衡微调 ---
-    if quantities[-1] == 0:
+    status, calculated_x, quantities = _solve_core(
+        total_quantity, total_price_with_tax / (1 + tax_rate), np.asarray(known_prices_tuple, dtype=np.float64),
+        x_lo, x_hi, rule_kind, rule_val, max_iterations
+    )
+    if status == SOLVE_INFEASIBLE:
+        return {"status": "错误", "message": f"特殊限制逻辑冲突：在您设定的限制条件下，无法凑出商品总件数 ({int(total_quantity)})。"}
+    if status == SOLVE_ZERO_UNKNOWN:
         return {"status": "错误", "message": "计算错误：根据您的特殊限制，分配给未知单价商品的数量为0，导致其价格无法计算。"}
-        
-    priced_items = sorted([(price, i) for i, price in enumerate(known_prices)], key=lambda item: item[0])
-    target_pre_tax_price = total_price_with_tax / (1 + tax_rate)
-
-    for i in range(200): # max_iterations
-        known_items_price = sum(quantities[j] * known_prices[j] for j in range(total_products - 1))
-        calculated_x = (target_pre_tax_price - known_items_price) / quantities[-1]
-
-        if x_price_range[0] <= calculated_x <= x_price_range[1]:
-            return {"status": "成功", "message": "找到最优解。", "counts": quantities, "estimated_price_x": round(calculated_x, 4)}
-
-        def is_valid_swap(qtys, from_idx, to_idx, rules):
-            if from_idx in rules:
-                rule = rules[from_idx]
-                if rule['type'] == '==' or (rule['type'] == '>=' and qtys[from_idx] - 1 < rule['value']): return False
-            if to_idx in rules:
-                rule = rules[to_idx]
-                if rule['type'] == '==' or (rule['type'] == '<=' and qtys[to_idx] + 1 > rule['value']): return False
-            return True
-
-        swapped = False
-        if calculated_x > x_price_range[1]:
-            for _, low_idx in priced_items:
-                if quantities[low_idx] > 0:
-                    for _, high_idx in reversed(priced_items):
-                        if low_idx != high_idx and is_valid_swap(quantities, low_idx, high_idx, rules):
-                            quantities[low_idx] -= 1; quantities[high_idx] += 1; swapped = True; break
-                if swapped: break
-        elif calculated_x < x_price_range[0]:
-            for _, high_idx in reversed(priced_items):
-                if quantities[high_idx] > 0:
-                    for _, low_idx in priced_items:
-                        if low_idx != high_idx and is_valid_swap(quantities, high_idx, low_idx, rules):
-                            quantities[high_idx] -= 1; quantities[low_idx] += 1; swapped = True; break
-                if swapped: break
-        if not swapped: break
-
-    final_x = (target_pre_tax_price - sum(quantities[j] * known_prices[j] for j in range(total_products - 1))) / quantities[-1]
-    return {"status": "警告", "message": "计算警告：在满足您所有输入和限制条件下，无法找到一个能让未知商品单价落在预设范围内的数量组合。当前最接近的结果已显示。", "counts": quantities, "estimated_price_x": round(final_x, 4)}
+    counts = tuple(quantities.tolist())
+
+    if status == SOLVE_SUCCESS:
+        return {"status": "成功", "message": "找到最优解。", "counts": counts, "estimated_price_x": round(calculated_x, 4)}
+    return {"status": "警告", "message": "计算警告：在满足您所有输入和限制条件下，无法找到一个能让未知商品单价落在预设范围内的数量组合。当前最接近的结果已显示。", "counts": counts, "estimated_price_x": round(calculated_x, 4)}
+
+def solve_product_distribution(
+    total_products: int,
+    total_quantity: int,
+    total_price_with_tax: float,
+    tax_rate: float,
+    known_prices: list[float],
+    x_price_range: list[float],
+    constraints: list = None,
+    max_iterations: int = 200
+) -> dict:
+    """核心计算函数，已内置逻辑冲突检测（相同输入直接命中缓存）。
+    max_iterations 只限制迭代求解：没有限制条件时的解析解不受此上限约束，
+    解析解落不进单价区间而退回迭代时则仍受此上限约束"""
+    constraints_tuple = tuple((c['idx'], c['type'], c['value']) for c in constraints) if constraints else ()
+    result = dict(_solve_product_distribution_cached(
+        total_products, total_quantity, total_price_with_tax, tax_rate,
+        tuple(np.asarray(known_prices, dtype=np.float64).tolist()), tuple(x_price_range), constraints_tuple, max_iterations
+    ))
+    if 'counts' in result:
+        result['counts'] = list(result['counts'])
+    return result
+
+@st.cache_resource(show_spinner=False)
+def _warmup_solver() -> bool:
+    """每个服务进程只执行一次：用默认界面的规模（7 个已知商品 + 1 个未知商品）空跑一次内核，
+    把首次调用的开销放在启动阶段，而不是用户第一次点击“开始计算”时"""
+    balance_prices(np.ones(8, np.int64), np.zeros(7, np.float64), np.arange(7, dtype=np.int64), 0.0, 0.0, 1.0,
+                   np.full(8, -1, np.int8), np.zeros(8, np.int64), 1)
+    return True
+
+_warmup_solver()
 
 # --------------------------------------------------------------------------
 #  网站界面代码 - 已升级
 # --------------------------------------------------------------------------
-if 'constraints' not in st.session_state:
-    st.session_state.constraints = []
-
 st.set_page_config(page_title="智能商品件数分配器", layout="wide")
+# 每个会话各自的初始化，只在会话首次运行时生效（不能用 st.cache_resource，那是所有会话共享的）
+st.session_state.setdefault('constraints', [])
 st.title("📦 智能商品件数分配器")
 
 # ... [UI代码与上一版相同，此处省略以保持简洁] ...
-col1, col2 = st.columns(2)
-with col1:
-    st.subheader("基本信息")
-    total_quantity_input = st.number_input("1. 商品总件数 (N)", value=92, min_value=1)
-    total_price_input = st.number_input("2. 含税总价 (P_total)", value=31595.16, min_value=0.01)
-    tax_rate_input = st.number_input("3. 税率 (R)", value=0.13, min_value=0.0, max_value=1.0, format="%.4f")
-with col2:
-    st.subheader("商品价格")
-    prices_str = st.text_area("4. 已知商品单价列表 (英文逗号隔开)", "218, 268, 258, 308, 228, 480, 318")
-    st.info("未知商品的价格范围将根据上方列表的最高价和最低价自动设定。")
+# 所有基本输入放在表单中：编辑过程中不触发重跑，点击“开始计算”时一次性提交
+with st.form("calc_form"):
+    col1, col2 = st.columns(2)
+    with col1:
+        st.subheader("基本信息")
+        total_quantity_input = st.number_input("1. 商品总件数 (N)", value=92, min_value=1)
+        total_price_input = st.number_input("2. 含税总价 (P_total)", value=31595.16, min_value=0.01)
+        tax_rate_input = st.number_input("3. 税率 (R)", value=0.13, min_value=0.0, max_value=1.0, format="%.4f")
+    with col2:
+        st.subheader("商品价格")
+        prices_str = st.text_area("4. 已知商品单价列表 (英文逗号隔开)", "218, 268, 258, 308, 228, 480, 318")
+        st.info("未知商品的价格范围将根据上方列表的最高价和最低价自动设定。")
+    submitted = st.form_submit_button("🚀 开始计算", use_container_width=True, type="primary")
 st.divider()
 st.subheader("特殊限制 (可选)")
-if st.checkbox("启用特殊限制（如季节、库存等）"):
-    st.caption("在这里为特定商品添加数量限制。商品序号从1开始，对应上方价格列表的顺序。")
-    for i, constraint in enumerate(st.session_state.constraints):
-        c1, c2, c3, c4 = st.columns([2, 3, 2, 1])
-        constraint['idx'] = c1.number_input("商品序号", min_value=1, key=f"idx_{i}", value=constraint['idx'])
-        constraint['type'] = c2.selectbox("限制类型", options=['<= (最多)', '>= (最少)', '== (固定为)'], key=f"type_{i}", index=['<= (最多)', '>= (最少)', '== (固定为)'].index(constraint['type']))
-        constraint['value'] = c3.number_input("数量", min_value=0, key=f"val_{i}", value=constraint['value'])
-        if c4.button("删除", key=f"del_{i}"):
-            st.session_state.constraints.pop(i)
-            st.rerun()
-    if st.button("➕ 增加一条限制"):
-        st.session_state.constraints.append({'idx': 1, 'type': '<= (最多)', 'value': 1})
-        st.rerun()
+# 限制编辑器放在 fragment 中：增删限制只重跑这一块，不必重跑整个页面
+# （增删操作放在 on_click 回调里，回调先于重跑执行，因此无需再调用 st.rerun）
+@st.fragment
+def _constraints_editor():
+    if st.checkbox("启用特殊限制（如季节、库存等）"):
+        st.caption("在这里为特定商品添加数量限制。商品序号从1开始，对应上方价格列表的顺序。")
+        for i, constraint in enumerate(st.session_state.constraints):
+            c1, c2, c3, c4 = st.columns([2, 3, 2, 1])
+            constraint['idx'] = c1.number_input("商品序号", min_value=1, key=f"idx_{i}", value=constraint['idx'])
+            constraint['type'] = c2.selectbox("限制类型", options=['<= (最多)', '>= (最少)', '== (固定为)'], key=f"type_{i}", index=['<= (最多)', '>= (最少)', '== (固定为)'].index(constraint['type']))
+            constraint['value'] = c3.number_input("数量", min_value=0, key=f"val_{i}", value=constraint['value'])
+            c4.button("删除", key=f"del_{i}", on_click=st.session_state.constraints.pop, args=(i,))
+        st.button("➕ 增加一条限制", on_click=st.session_state.constraints.append, args=({'idx': 1, 'type': '<= (最多)', 'value': 1},))
+
+_constraints_editor()
 st.divider()
 
-if st.button("🚀 开始计算", use_container_width=True, type="primary"):
+if submitted:
     # --- 步骤一：执行“安检” ---
     active_constraints = [c for c in st.session_state.get('constraints', [])]
-    validation_errors = validate_inputs(
+    constraints_key = tuple((c['idx'], c['type'], c['value']) for c in active_constraints)
+    validation_errors = _validate(
         total_quantity=total_quantity_input,
         total_price=total_price_input,
         tax_rate=tax_rate_input,
         prices_str=prices_str,
-        constraints=active_constraints
+        constraints_key=constraints_key
     )
 
     if validation_errors:
@@ -216,9 +340,9 @@ if st.button("🚀 开始计算", use_container_width=True, type="primary"):
     else:
         # --- 步骤二：“安检”通过，正式计算 ---
         try:
-            known_prices_list = [float(p.strip()) for p in prices_str.split(',')]
-            total_products_count = len(known_prices_list) + 1
-            x_range_auto = [min(known_prices_list), max(known_prices_list)] if known_prices_list else [0,0]
+            known_prices_arr = _parse_prices(prices_str)
+            total_products_count = len(known_prices_arr) + 1
+            x_range_auto = [float(known_prices_arr.min()), float(known_prices_arr.max())] if known_prices_arr.size else [0,0]
             
             clean_constraints = [{'idx': c['idx'], 'type': c['type'].split(' ')[0], 'value': c['value']} for c in active_constraints]
 
@@ -227,7 +351,7 @@ if st.button("🚀 开始计算", use_container_width=True, type="primary"):
                 total_quantity=int(total_quantity_input),
                 total_price_with_tax=float(total_price_input),
                 tax_rate=float(tax_rate_input),
-                known_prices=known_prices_list,
+                known_prices=known_prices_arr,
                 x_price_range=x_range_auto,
                 constraints=clean_constraints
             )
@@ -0,0 +1,73 @@
+import numpy as np
+from numba import njit
+
+# --------------------------------------------------------------------------
+#  价格平衡内核 - 由 Numba 编译为机器码
+#  单独成模块：Numba 的磁盘缓存以源文件为键，且显式签名使其在导入时即完成编译（或从缓存加载）
+# --------------------------------------------------------------------------
+# 限制类型编码：-1 表示无限制
+RULE_CODES = {'<=': 0, '>=': 1, '==': 2}
+
+@njit('void(int64[:], int8[:], int64[:], boolean[:], boolean[:], int64)', cache=True)
+def refresh_swap_flags(quantities, rule_kind, rule_val, can_dec, can_inc, idx):
+    # 无分支写法：固定数量的商品不能转出也不能转入；转出要有存量且不能跌破下限，转入不能超过上限
+    can_dec[idx] = (quantities[idx] > 0) & (rule_kind[idx] != 2) & ((rule_kind[idx] != 1) | (quantities[idx] - 1 >= rule_val[idx]))
+    can_inc[idx] = (rule_kind[idx] != 2) & ((rule_kind[idx] != 0) | (quantities[idx] + 1 <= rule_val[idx]))
+
+@njit('int64(int64[:], boolean[:], int64)', cache=True)
+def first_eligible(order, eligible, skip):
+    # 按给定顺序返回第一件符合条件且不是 skip 的商品，没有则返回 -1
+    for idx in order:
+        if eligible[idx] and idx != skip:
+            return idx
+    return -1
+
+@njit('Tuple((int64[:], float64, boolean))(int64[:], float64[:], int64[:], float64, float64, float64, int8[:], int64[:], int64)', cache=True)
+def balance_prices(quantities, known_prices, sorted_idx_asc, target_pre_tax, x_lo, x_hi, rule_kind, rule_val, max_iter):
+    """逐件调换已知商品的数量，使未知单价落入 [x_lo, x_hi]；返回 (数量, 未知单价, 是否成功)"""
+    n_known = known_prices.shape[0]
+    last_idx = quantities.shape[0] - 1
+    sorted_idx_desc = sorted_idx_asc[::-1]
+
+    # 已知商品总价只在开头整体计算一次，之后每次调换按差价增量更新
+    known_items_price = (quantities[:n_known] * known_prices).sum()
+    # 每件商品能否再转出/转入一件；每次调换后只刷新涉及的两件商品
+    can_dec = np.empty(quantities.shape[0], dtype=np.bool_)
+    can_inc = np.empty(quantities.shape[0], dtype=np.bool_)
+    for i in range(quantities.shape[0]):
+        refresh_swap_flags(quantities, rule_kind, rule_val, can_dec, can_inc, i)
+
+    # 记录上一次调换和上一轮的未知单价，用于识别来回振荡或原地踏步
+    last_from, last_to = -1, -1
+    prev_x = np.inf
+    # 调换只发生在已知商品之间，未知商品的件数在循环中不变，倒数可提前算好
+    inv_q_last = 1.0 / quantities[last_idx]
+    for _ in range(max_iter):
+        calculated_x = (target_pre_tax - known_items_price) * inv_q_last
+
+        if x_lo <= calculated_x <= x_hi:
+            return quantities, calculated_x, True
+        if abs(calculated_x - prev_x) < 1e-9: break
+        prev_x = calculated_x
+
+        # 未知单价偏高：从便宜的商品转给贵的商品；偏低则反过来
+        if calculated_x > x_hi:
+            donor_order, receiver_order = sorted_idx_asc, sorted_idx_desc
+        else:
+            donor_order, receiver_order = sorted_idx_desc, sorted_idx_asc
+        from_idx = first_eligible(donor_order, can_dec, -1)
+        to_idx = first_eligible(receiver_order, can_inc, from_idx)
+        if from_idx >= 0 and to_idx < 0:
+            # 唯一能转入的就是首选的转出方，只能换下一个转出方
+            to_idx = first_eligible(receiver_order, can_inc, -1)
+            from_idx = first_eligible(donor_order, can_dec, to_idx) if to_idx >= 0 else -1
+        # 没有可行的调换，或者这次调换恰好撤销上一次调换（越过目标区间后来回振荡），都无需继续
+        if from_idx < 0 or to_idx < 0 or (from_idx == last_to and to_idx == last_from): break
+
+        quantities[from_idx] -= 1; quantities[to_idx] += 1
+        known_items_price += known_prices[to_idx] - known_prices[from_idx]
+        last_from, last_to = from_idx, to_idx
+        refresh_swap_flags(quantities, rule_kind, rule_val, can_dec, can_inc, from_idx)
+        refresh_swap_flags(quantities, rule_kind, rule_val, can_dec, can_inc, to_idx)
+
+    return quantities, (target_pre_tax - known_items_price) * inv_q_last, False